@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import textwrap
 import shutil
 import subprocess
@@ -13,6 +14,60 @@ def pre_install_deps() -> None:
     subprocess.run(['apt', 'install', '-y', 'python3-pip',])
     subprocess.run(['apt', 'install', '-y', 'python3-aiohttp',])
 
+def write_file(path: Path, content: str, mode: int) -> None:
+    """Write content to the given path with the given mode, atomically replacing any old file."""
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content.encode())
+
+    os.replace(tmp_path, path)
+
+def copy_file(src: Path, dest: Path, mode: int) -> None:
+    """Copy src to dest with the given mode, atomically replacing any old file."""
+    tmp_path = dest.with_name(f'.{dest.name}.tmp')
+
+    shutil.copyfile(src, tmp_path)
+    tmp_path.chmod(mode)
+
+    os.replace(tmp_path, dest)
+
+def systemctl(*actions: str) -> None:
+    """
+    Run the given systemctl actions (daemon-reload, enable, disable, start or stop) for
+    the agent service. When pystemd is installed the actions are sent to systemd through
+    D-Bus, instead of spawning a systemctl process for each one.
+    """
+    try:
+        from pystemd.dbusexc import DBusBaseError
+        from pystemd.systemd1 import Manager
+    except ImportError:
+        for action in actions:
+            unit = [] if action == 'daemon-reload' else ['agent']
+            subprocess.run(['systemctl', action, *unit])
+
+        return
+
+    unit = b'agent.service'
+
+    with Manager() as manager:
+        dbus_actions = {
+            'daemon-reload': lambda: manager.Manager.Reload(),
+            'enable': lambda: manager.Manager.EnableUnitFiles([unit], False, True),
+            'disable': lambda: manager.Manager.DisableUnitFiles([unit], False),
+            'start': lambda: manager.Manager.StartUnit(unit, b'replace'),
+            'stop': lambda: manager.Manager.StopUnit(unit, b'replace'),
+        }
+
+        for action in actions:
+            try:
+                dbus_actions[action]()
+            except DBusBaseError as e:
+                # Like systemctl failures, report the error and carry on.
+                print(f'Failed to {action} agent.service: {e}')
+
 def systemd_setup(remove: bool = False) -> None:
     """Install or remove the systemd service for the Shebang Remote Agent."""
     systemd_file = Path('/etc/systemd/system/agent.service')
@@ -21,9 +76,7 @@ def systemd_setup(remove: bool = False) -> None:
 
     if remove:
         # Remove agent's systemd config
-        subprocess.run(['systemctl', 'stop', 'agent'])
-        subprocess.run(['systemctl', 'disable', 'agent'])
-        subprocess.run(['systemctl', 'daemon-reload'])
+        systemctl('stop', 'disable', 'daemon-reload')
         systemd_file.unlink()
 
         # Removes /usr/local/bin/agent.py
@@ -31,13 +84,9 @@ def systemd_setup(remove: bool = False) -> None:
 
     else:
         # Copy agent.py to /usr/local/bin/
-        shutil.copy(agent_src, agent_dest)
-        agent_dest.chmod(0o755)
+        copy_file(agent_src, agent_dest, 0o755)
 
         # Setup agent's systemd config
-        systemd_file.touch()
-        systemd_file.chmod(0o644)
-
         systemd_file_content = textwrap.dedent("""
                [Unit]
                Description=Shebang Remote Agent Service
@@ -56,11 +105,9 @@ def systemd_setup(remove: bool = False) -> None:
                WantedBy=multi-user.target
            """)
 
-        systemd_file.write_text(systemd_file_content)
+        write_file(systemd_file, systemd_file_content, 0o644)
 
-        subprocess.run(['systemctl', 'daemon-reload'])
-        subprocess.run(['systemctl', 'enable', 'agent'])
-        subprocess.run(['systemctl', 'start', 'agent'])
+        systemctl('daemon-reload', 'enable', 'start')
 
 def agent_config_setup(remove: bool = False) -> None:
     """Create or remove the configuration directory and file for the agent."""
@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
-import argparse
+import os
 import sys
 
 import aiohttp
 import asyncio
 import subprocess
+import socket
 import json
+import random
+import shlex
+import tempfile
 import uuid
 import logging
 
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict
-from aiohttp import ClientSession, ContentTypeError
+from typing import Any, Dict, NamedTuple, TYPE_CHECKING
+from aiohttp import ClientSession, ClientWebSocketResponse, ContentTypeError
+
+if TYPE_CHECKING:
+    # Only imported at runtime when the CLI arguments are parsed.
+    import argparse
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, the agent only requires the standard library and aiohttp.
+    orjson = None
 
 
 # Basic logging setup
@@ -21,93 +36,239 @@ logging.basicConfig(
     format='%(name)s - %(levelname)s - %(message)s',
 )
 
+def json_loads(data: bytes | str) -> Any:
+    """Parses the given JSON document, using orjson when it's available."""
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+def json_dumps(obj: Any) -> str:
+    """Serializes the given object to a JSON string, using orjson when it's available."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+
+    return json.dumps(obj)
+
+def json_dumps_pretty(obj: Any) -> bytes:
+    """Serializes the given object to indented JSON bytes, using orjson when it's available."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+
+    return (json.dumps(obj, indent=2) + '\n').encode()
+
+CONFIG_FILE_PATH = Path('/etc/agent/config.json')
+
+# Parsed configuration file content, keyed by the file's mtime.
+_config_cache: Dict[str, Any] = {'mtime': 0, 'data': {}}
+
 async def load_config() -> Dict[str, str]:
-    """Reads the agent's configuration file and returns it as a dictionary."""
-    config_file_path = Path('/etc/agent/config.json')
+    """
+    Reads the agent's configuration file and returns it as a dictionary.
+    The file is only re-read and parsed when its modification time changes.
+    """
+    try:
+        mtime = os.stat(CONFIG_FILE_PATH).st_mtime_ns
+    except OSError:
+        return {}
+
+    if mtime != _config_cache['mtime']:
+        # Read in a thread so a slow filesystem doesn't block the event loop.
+        content = await asyncio.to_thread(CONFIG_FILE_PATH.read_bytes)
+
+        # The setup script creates an empty config file until the agent is registered.
+        _config_cache['data'] = json_loads(content) if content.strip() else {}
+        _config_cache['mtime'] = mtime
 
-    if config_file_path.is_file():
-        return json.loads(config_file_path.read_text())
+    return _config_cache['data']
+
+def write_file_atomically(path: Path, data: bytes) -> None:
+    """Writes data to the given path through a temporary file, so it's never left half-written."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
 
-    return {}
+        os.replace(tmp_path, path)
+
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+def read_persisted_value(path: Path) -> str:
+    """Returns the stripped content of the given file, or an empty string if it can't be read."""
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return ''
+
+def persist_value(path: Path, value: str) -> None:
+    """Stores the given value in the given file so later runs can reuse it."""
+    try:
+        write_file_atomically(path, value.encode())
+    except OSError:
+        logging.exception('Unable to persist "%s" to %s.', value, path)
+
+# Agent identity, resolved once per process. The UUID is also persisted across runs.
+UUID_PATH = Path('/etc/agent_uuid')
+
+_agent_uuid: str | None = None
+_agent_name: str | None = None
 
 def get_or_create_agent_uuid() -> str:
-    random_uuid = str(uuid.uuid4())
+    """
+    Returns this machine's system UUID, or a random one if it can't be determined.
+    The UUID is read from sysfs, falling back to dmidecode only if that fails,
+    and then persisted to UUID_PATH so it's resolved only once per machine.
+    """
+    global _agent_uuid
+
+    if _agent_uuid:
+        return _agent_uuid
+
+    _agent_uuid = read_persisted_value(UUID_PATH)
+
+    if _agent_uuid:
+        return _agent_uuid
+
+    system_uuid = ''
 
     try:
-        system_uuid = subprocess.run(
-            ['dmidecode', '-s', 'system-uuid'], check=True, text=True, capture_output=True
-        )
+        # sysfs exposes the UUID in lowercase, while dmidecode prints it in uppercase.
+        system_uuid = Path('/sys/class/dmi/id/product_uuid').read_text().strip().upper()
+    except (PermissionError, FileNotFoundError):
+        pass
+
+    if not system_uuid:
+        try:
+            system_uuid = subprocess.run(
+                ['dmidecode', '-s', 'system-uuid'], check=True, text=True, capture_output=True
+            ).stdout.strip()
 
-        system_uuid = system_uuid.stdout.strip()
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            pass
 
-        if system_uuid:
-            return system_uuid
-        return random_uuid
+    _agent_uuid = system_uuid or str(uuid.uuid4())
+    persist_value(UUID_PATH, _agent_uuid)
 
-    except subprocess.CalledProcessError:
-        return random_uuid
+    return _agent_uuid
 
 def get_or_create_agent_name() -> str:
-    random_name = str(f'agent-{str(uuid.uuid4())[:5]}')
+    """Returns this machine's hostname, or a random agent name if it's not set."""
+    global _agent_name
+
+    if not _agent_name:
+        _agent_name = socket.gethostname() or f'agent-{str(uuid.uuid4())[:5]}'
+
+    return _agent_name
+
+@dataclass(frozen=True)
+class Endpoints:
+    """The server endpoints used by the agent, built once from the server base URL."""
+    server_url: str
+    register: str
+    commands_list: str
+    commands_ws: str
+    command_results: str
+
+    @classmethod
+    def build(cls, server_url: str, agent_id: str) -> 'Endpoints':
+        server_url = server_url.rstrip('/')
+
+        return cls(
+            server_url=server_url,
+            register=f'{server_url}/register_machine',
+            commands_list=f'{server_url}/commands/{agent_id}',
+            commands_ws=f'{server_url}/commands/ws/{agent_id}',
+            command_results=f'{server_url}/commands/results',
+        )
 
-    try:
-        name = subprocess.run(['hostname'], check=True, text=True, capture_output=True)
-        name = name.stdout.strip()
+    def command_result(self, command_id: str) -> str:
+        return f'{self.server_url}/commands/{command_id}/result'
 
-        if name:
-            return name
-        return random_name
+def create_client_session(interval: int = 300) -> ClientSession:
+    """
+    Creates the HTTP client session used to talk to the server.
+    Resolved addresses and idle connections are kept between polls, since the agent
+    always talks to the same server.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=16,
+        ttl_dns_cache=600,
+        keepalive_timeout=max(interval * 2, 600),
+    )
 
-    except subprocess.CalledProcessError:
-        return random_name
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=30),
+        json_serialize=json_dumps,
+    )
+
+class RequestResult(NamedTuple):
+    """The outcome of a request made to the server; status is 0 if the request failed."""
+    status: int
+    data: list[Any] | dict[str, Any] | None
+    etag: str | None = None
 
 async def make_request(
         session: ClientSession,
         *,
         url: str,
         method: str,
-        payload: dict | None = None,
-) -> tuple[int, list[Any] | dict[str, Any] | None]:
-    """This function makes a request to the given URL and returns (status, json) tuple."""
-    status, response_data = 0, None
+        payload: dict | list | None = None,
+        headers: dict[str, str] | None = None,
+        parse_json: bool = True,
+) -> RequestResult:
+    """
+    This function makes a request to the given URL and returns its (status, json) result.
+    The response body is only parsed when parse_json is set and the response has one.
+    """
+    status, response_data, etag = 0, None, None
 
     try:
-        async with session.request(method, url, json=payload) as response:
+        async with session.request(method, url, json=payload, headers=headers) as response:
             status = response.status
+            etag = response.headers.get('ETag')
 
-            try:
-                response_data = await response.json()
-            except ContentTypeError:
-                logging.exception('Error when getting response data:', exc_info=True)
+            if parse_json and status != 304:
+                try:
+                    response_data = await response.json(loads=json_loads)
+                except ContentTypeError:
+                    logging.exception('Error when getting response data:', exc_info=True)
 
     except Exception:
         logging.exception('Something went wrong when making a request.', exc_info=True)
 
-    return status, response_data
+    return RequestResult(status, response_data, etag)
 
 async def register_agent(
         session: ClientSession,
-        server_url: str,
+        endpoints: Endpoints,
         agent_id: str,
         agent_name: str
 ) -> bool:
     """
     Register this agent (machine) to the server.
     """
-    url = f'{server_url}/register_machine'
     payload = {'id': agent_id, 'name': agent_name}
 
-    status, data = await make_request(session, url=url, method='POST', payload=payload)
+    result = await make_request(
+        session, url=endpoints.register, method='POST', payload=payload, parse_json=False
+    )
 
-    if status == 200:
-        config_file = Path('/etc/agent/config.json')
+    if result.status == 200:
         config_content = dict(
-            server_url=server_url, agent_id=agent_id, agent_name=agent_name, interval=300
+            server_url=endpoints.server_url,
+            agent_id=agent_id,
+            agent_name=agent_name,
+            interval=300,
         )
 
         try:
-            with open(config_file, 'w') as f:
-                json.dump(config_content, f, indent=4)
+            await asyncio.to_thread(
+                write_file_atomically, CONFIG_FILE_PATH, json_dumps_pretty(config_content)
+            )
         except Exception as e:
             print('Something went wrong when writing the agent configuration file:', e)
         else:
@@ -120,81 +281,435 @@ async def register_agent(
 
     return False
 
+# ETag of the last pending commands response, sent back to skip unchanged responses.
+_pending_commands_etag: str | None = None
+
 async def check_pending_commands(
         session: ClientSession,
-        server_url: str,
-        agent_id: str
-) -> list[dict[str, Any]]:
-    """Request the server to check if there are any pending commands for this agent."""
+        endpoints: Endpoints
+) -> RequestResult:
+    """
+    Request the server to check if there are any pending commands for this agent.
+    The result keeps the response status, so callers can tell a failed request from
+    an empty list; its data is always a list of commands.
+    """
+    global _pending_commands_etag
+
     logging.info('Checking pending commands.')
 
-    url = f'{server_url}/commands/{agent_id}'
+    # Let the server answer 304 Not Modified, with no body, while nothing changed.
+    headers = {'If-None-Match': _pending_commands_etag} if _pending_commands_etag else None
+
+    result = await make_request(
+        session, url=endpoints.commands_list, method='GET', headers=headers
+    )
+
+    if result.status == 200:
+        _pending_commands_etag = result.etag
+        return RequestResult(result.status, result.data or [], result.etag)
 
-    status, data = await make_request(session, url=url, method='GET')
+    return RequestResult(result.status, [], result.etag)
 
-    if status == 200:
-        return data
+# Upper bound, in seconds, for the delay between retries when the server is failing.
+MAX_BACKOFF = 3600
 
-    return []
+def get_backoff_delay(base: float, failures: int) -> float:
+    """Returns a retry delay using exponential backoff with full jitter."""
+    return random.uniform(0, min(MAX_BACKOFF, base * 2 ** failures))
 
 async def send_command_result(
         session: ClientSession,
-        server_url: str,
+        endpoints: Endpoints,
         command_id: str,
         command: str,
         command_output: dict[str, str]
-) -> None:
+) -> bool:
     """
     Sends a command result (output) to the server.
     After a command was executed, the command output must be sent back to the server.
+    Returns whether there's nothing left to deliver for this command.
     """
-    url = f'{server_url}/commands/{command_id}/result'
-
     payload = {'output': command_output}
 
-    status, data = await make_request(session, url=url, method='POST', payload=payload)
+    result = await make_request(
+        session, url=endpoints.command_result(command_id), method='POST', payload=payload
+    )
 
-    if status == 200:
-        logging.info(f'Successfully sent command result for command: {command}')
+    if result.status == 200:
+        logging.info('Successfully sent command result for command: %s', command)
     else:
-        logging.error(f'Error when sending command result for command: {command}: {data}')
+        logging.error(
+            'Error when sending command result for command: %s: %s', command, result.data
+        )
+
+    # A command that no longer exists on the server has no use for its result.
+    return result.status in (200, 404)
+
+async def send_command_results(
+        session: ClientSession,
+        endpoints: Endpoints,
+        results: list[tuple[str, str, dict[str, str]]]
+) -> list[str]:
+    """
+    Sends the results of several commands, as (command_id, command, output) tuples, to
+    the server in a single request. Falls back to sending them one by one when the
+    server doesn't support it, or when one of the commands wasn't found.
+    Returns the ids of the commands whose results were delivered.
+    """
+    if len(results) > 1:
+        payload = [{'id': command_id, 'output': output} for command_id, _, output in results]
+
+        result = await make_request(
+            session, url=endpoints.command_results, method='POST', payload=payload
+        )
+
+        if result.status == 200:
+            logging.info('Successfully sent %d command results.', len(results))
+            return [command_id for command_id, _, _ in results]
+
+        if result.status not in (404, 405):
+            logging.error('Error when sending %d command results: %s', len(results), result.data)
+            return []
+
+    sent_ids = []
+
+    for command_id, command, output in results:
+        if await send_command_result(
+                session, endpoints, command_id, command=command, command_output=output
+        ):
+            sent_ids.append(command_id)
+
+    return sent_ids
+
+# Commands pushed through the WebSocket that are being handled, by id. Keeps references to
+# their tasks so they aren't garbage collected.
+_running_commands: dict[str, asyncio.Task] = {}
+
+# Results that couldn't be delivered, as (command, output) pairs by command id. They're
+# sent again later, rather than executing their commands again.
+_unsent_results: dict[str, tuple[str, dict[str, Any]]] = {}
+
+# Ids of the commands whose results were recently delivered, oldest first. The server
+# keeps pushing a command until it gets its result, so it may push one that just finished.
+_finished_command_ids: dict[str, None] = {}
+FINISHED_COMMAND_IDS_LIMIT = 1000
+
+def is_known_command(command_id: str) -> bool:
+    """Whether the given command is running or already ran in this process."""
+    return (
+        command_id in _running_commands
+        or command_id in _unsent_results
+        or command_id in _finished_command_ids
+    )
+
+def mark_result_sent(command_id: str) -> None:
+    """Remembers that the given command's result was delivered."""
+    _unsent_results.pop(command_id, None)
+    _finished_command_ids[command_id] = None
+
+    if len(_finished_command_ids) > FINISHED_COMMAND_IDS_LIMIT:
+        del _finished_command_ids[next(iter(_finished_command_ids))]
+
+async def send_unsent_results(
+        session: ClientSession,
+        endpoints: Endpoints,
+        command_ids: list[str] | None = None
+) -> None:
+    """
+    Sends the results that weren't delivered yet, or only those of the given commands.
+    The ones that still can't be delivered are kept for the next attempt.
+    """
+    if command_ids is None:
+        command_ids = list(_unsent_results)
+
+    results = [
+        (command_id, *_unsent_results[command_id])
+        for command_id in command_ids if command_id in _unsent_results
+    ]
+
+    if not results:
+        return
+
+    for command_id in await send_command_results(session, endpoints, results):
+        mark_result_sent(command_id)
+
+# Maximum amount of a command's stdout/stderr sent to the server; beyond it,
+# only the end of the output is kept.
+MAX_OUTPUT_BYTES = 1024 * 1024
+
+async def read_stream_tail(stream: asyncio.StreamReader, limit: int = MAX_OUTPUT_BYTES) -> bytes:
+    """Reads the given stream until EOF, keeping only its last `limit` bytes in memory."""
+    buffer = bytearray()
+
+    while chunk := await stream.read(65536):
+        buffer += chunk
+
+        # Trim in batches rather than on every chunk to avoid moving the buffer around.
+        if len(buffer) > 2 * limit:
+            del buffer[:-limit]
+
+    return bytes(buffer[-limit:])
+
+# Characters that only a shell can interpret (pipes, redirections, globs, expansions, ...).
+SHELL_METACHARACTERS = frozenset(';|&$`<>*?[]{}()~#\\\n')
+
+async def spawn_command(command: str) -> asyncio.subprocess.Process:
+    """
+    Spawns the given command with its stdout and stderr piped. Simple commands are
+    executed directly, anything that needs a shell is run through /bin/sh.
+    """
+    pipes = dict(stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    if not SHELL_METACHARACTERS.intersection(command):
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            argv = []
+
+        # A leading VAR=value assignment also needs a shell.
+        if argv and '=' not in argv[0]:
+            try:
+                return await asyncio.create_subprocess_exec(*argv, **pipes)
+            except OSError:
+                # Not something exec can run (e.g. a shell builtin like cd, or a script
+                # without a shebang), let the shell handle it.
+                pass
+
+    return await asyncio.create_subprocess_shell(command, **pipes)
+
+async def run_command(command: str) -> dict[str, Any]:
+    """Execute the given command and return its output."""
+    logging.info('Executing command: %s', command)
+
+    proc = await spawn_command(command)
+
+    try:
+        stdout, stderr, _ = await asyncio.wait_for(
+            asyncio.gather(
+                read_stream_tail(proc.stdout), read_stream_tail(proc.stderr), proc.wait()
+            ),
+            timeout=60,
+        )
+
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+        output = {'stdout': '', 'stderr': 'TimeoutExpired', 'returncode': 1}
+
+        logging.error('Command output: %s', output)
+
+        return output
+
+    output = {
+        'stdout': stdout.decode(errors='replace').strip(),
+        'stderr': stderr.decode(errors='replace').strip(),
+        'returncode': proc.returncode
+    }
+
+    logging.info('Command output: %s', output)
+
+    return output
 
 async def execute_command(
         session: ClientSession,
-        server_url: str,
+        endpoints: Endpoints,
         command_id: str,
         command: str
 ) -> None:
     """Execute the given command and send its result to the server."""
     try:
-        logging.info(f'Executing command: {command}')
+        _unsent_results[command_id] = (command, await run_command(command))
 
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=60)
+        await send_unsent_results(session, endpoints, [command_id])
 
-        output = {
-            'stdout': result.stdout.strip(),
-            'stderr': result.stderr.strip(),
-            'returncode': result.returncode
-        }
+    except Exception:
+        logging.exception('Error when executing the command "%s":', command, exc_info=True)
 
-        logging.info(f'Command output: {output}')
+async def execute_commands(
+        session: ClientSession,
+        endpoints: Endpoints,
+        commands: list[tuple[str, str]]
+) -> None:
+    """
+    Execute the given (command_id, command) pairs concurrently, since they're independent,
+    then send all their results to the server at once, along with any earlier results that
+    couldn't be delivered. Commands that already ran aren't executed again.
+    """
+    commands = [
+        (command_id, command) for command_id, command in commands
+        if not is_known_command(command_id)
+    ]
 
-        await send_command_result(
-            session, server_url, command_id, command=command, command_output=output
-        )
+    outputs = await asyncio.gather(
+        *(run_command(command) for _, command in commands), return_exceptions=True
+    )
 
-    except subprocess.TimeoutExpired:
-        output = {'stdout': '', 'stderr': 'TimeoutExpired', 'returncode': 1}
+    for (command_id, command), output in zip(commands, outputs):
+        if isinstance(output, Exception):
+            logging.error('Error when executing the command "%s":', command, exc_info=output)
+        else:
+            _unsent_results[command_id] = (command, output)
 
-        logging.error(f'Command output: {output}')
-        await send_command_result(
-            session, server_url, command_id, command=command, command_output=output
-        )
+    await send_unsent_results(session, endpoints)
 
-    except Exception:
-        logging.exception(f'Error when executing the command "{command}":', exc_info=True)
+def parse_commands(data: Any) -> list[tuple[str, str]]:
+    """
+    Returns the (command_id, command) pairs of the given list of pending commands.
+    Anything that isn't a command with an id and a script content is ignored.
+    """
+    if not isinstance(data, list):
+        return []
+
+    return [
+        (cmd_response['id'], cmd_response['script']['content'])
+        for cmd_response in data
+        if isinstance(cmd_response, dict)
+        and cmd_response.get('id')
+        and isinstance(cmd_response.get('script'), dict)
+        and cmd_response['script'].get('content')
+    ]
+
+async def send_heartbeats(
+        session: ClientSession,
+        endpoints: Endpoints,
+        ws: ClientWebSocketResponse,
+        interval: int
+) -> None:
+    """
+    Periodically let the server know this agent is still alive, and retry delivering
+    the results it didn't get.
+    """
+    while not ws.closed:
+        await asyncio.sleep(interval)
+        await ws.send_str('ping')
+
+        await send_unsent_results(session, endpoints)
+
+def handle_pushed_command(
+        session: ClientSession,
+        endpoints: Endpoints,
+        command_id: str,
+        command: str
+) -> None:
+    """
+    Execute a command pushed by the server in the background. Commands are pushed again
+    on every connection until their result is delivered, so a command that's running is
+    skipped, and one that already ran only gets its result sent again.
+    """
+    if command_id in _running_commands:
+        return
+
+    if command_id in _unsent_results:
+        coro = send_unsent_results(session, endpoints, [command_id])
+    elif command_id in _finished_command_ids:
+        return
+    else:
+        coro = execute_command(session, endpoints, command_id=command_id, command=command)
+
+    task = asyncio.create_task(coro)
+    _running_commands[command_id] = task
+    task.add_done_callback(lambda _: _running_commands.pop(command_id, None))
+
+async def listen_pending_commands(
+        session: ClientSession,
+        endpoints: Endpoints,
+        interval: int
+) -> None:
+    """
+    Receive pending commands pushed by the server through a WebSocket and execute them.
+    Returns when the connection is closed; raises aiohttp.WSServerHandshakeError if the
+    server doesn't accept the WebSocket connection.
+    """
+    async with session.ws_connect(endpoints.commands_ws, heartbeat=30) as ws:
+        logging.info('Listening for pending commands.')
+
+        heartbeat = asyncio.create_task(send_heartbeats(session, endpoints, ws, interval))
+
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+
+                try:
+                    commands = parse_commands(msg.json(loads=json_loads))
+                except ValueError:
+                    logging.error('Ignoring malformed pending commands message: %.200s', msg.data)
+                    continue
+
+                for cmd_id, cmd in commands:
+                    handle_pushed_command(session, endpoints, cmd_id, cmd)
+
+        finally:
+            heartbeat.cancel()
+
+# How long, in seconds, the agent polls before trying the WebSocket again, in case the
+# server was upgraded in the meantime.
+WEBSOCKET_RETRY_INTERVAL = 3600
+
+async def poll_pending_commands(
+        session: ClientSession,
+        endpoints: Endpoints,
+        interval: int,
+        duration: float
+) -> None:
+    """Poll for pending commands and execute them, for the given duration in seconds."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+
+    # Consecutive failed attempts to reach the server, used to back off retries.
+    failures = 0
+
+    while loop.time() < deadline:
+        result = await check_pending_commands(session, endpoints)
+
+        await execute_commands(session, endpoints, parse_commands(result.data))
+
+        if result.status in (200, 304):
+            failures = 0
+            await asyncio.sleep(interval)
+
+        else:
+            failures += 1
+            await asyncio.sleep(get_backoff_delay(interval, failures))
+
+async def run_agent(session: ClientSession, endpoints: Endpoints, interval: int) -> None:
+    """Runs the agent main loop, executing the commands scheduled for this agent."""
+    # Consecutive failed attempts to reach the server, used to back off retries.
+    failures = 0
+
+    # Prefer having commands pushed through a WebSocket, falling back to polling
+    # when the server doesn't support it.
+    while True:
+        try:
+            await listen_pending_commands(session, endpoints, interval)
+            failures = 0
+
+        except aiohttp.WSServerHandshakeError as e:
+            # Other statuses (e.g. 502/503 while the server restarts, or 403 for an unknown
+            # machine) are failures like any other, the WebSocket is retried after them.
+            if e.status in (404, 405):
+                logging.info('WebSocket unavailable (%s), polling for commands.', e.status)
+
+                await poll_pending_commands(session, endpoints, interval, WEBSOCKET_RETRY_INTERVAL)
+                failures = 0
+                continue
+
+            logging.error('WebSocket handshake failed (%s).', e.status)
+            failures += 1
+
+        # The session's total timeout can also expire during the handshake.
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logging.exception('WebSocket connection failed.', exc_info=True)
+            failures += 1
+
+        # Jitter reconnections so agents don't all reconnect at once after a restart.
+        await asyncio.sleep(get_backoff_delay(interval, failures))
+
+def parse_args() -> 'argparse.Namespace':
+    """Parses the agent's command line arguments."""
+    import argparse
 
-async def main():
     parser = argparse.ArgumentParser(
         description='#! Remote - An Agent to manage Linux systems remotely from Discord.'
     )
@@ -208,49 +723,50 @@ async def main():
     reg.add_argument('--name', required=False, help='Name of the machine')
     reg.add_argument('--server', required=True, help='Base URL of the FastAPI server')
 
-    args = parser.parse_args()
+    return parser.parse_args()
+
+async def main():
+    # systemd runs the agent without arguments, so skip the CLI parser entirely then.
+    args = parse_args() if len(sys.argv) > 1 else None
 
-    if args.command == 'register':
+    if args and args.command == 'register':
         print('Registering agent...')
         agent_id = get_or_create_agent_uuid()
         agent_name = get_or_create_agent_name()
 
-        async with aiohttp.ClientSession() as session:
+        # Registration writes a new config file, the current one is never read.
+        async with create_client_session() as session:
             registered = await register_agent(
                 session,
-                server_url=args.server.rstrip('/'),
+                endpoints=Endpoints.build(args.server, agent_id),
                 agent_id=agent_id,
                 agent_name=agent_name
             )
 
-            if registered:
-                print('Done! :)')
-            else:
-                print('Failed :(')
+        if registered:
+            print('Done! :)')
+        else:
+            print('Failed :(')
 
     else:
         logging.info('Running the agent main loop.')
 
         config = await load_config()
-
-        server_url = config.get('server_url', '').rstrip('/')
-        agent_id = config['agent_id']
         interval = config.get('interval', 300)
 
-        async with aiohttp.ClientSession() as session:
-            while True:
-                commands_response = await check_pending_commands(session, server_url, agent_id)
+        endpoints = Endpoints.build(config.get('server_url', ''), config['agent_id'])
 
-                for cmd_response in commands_response:
-                    cmd_id = cmd_response.get('id', '')
-                    cmd = cmd_response.get('script', {}).get('content')
-
-                    if cmd_id and cmd:
-                        await execute_command(
-                            session, server_url, command_id=cmd_id, command=cmd
-                        )
-
-                await asyncio.sleep(interval)
+        # A single session, and so a single connection pool, serves every request.
+        async with create_client_session(interval) as session:
+            await run_agent(session, endpoints, interval)
 
 if __name__ == '__main__':
+    try:
+        import uvloop
+    except ImportError:
+        # uvloop is optional, the default asyncio event loop works just as well.
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     asyncio.run(main())
@@ -1,26 +1,99 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
 import logging
-import json
+import queue
 import sys
+import time
 
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import discord
 import aiohttp
+import orjson
 
 from pathlib import Path
 
 from discord.ext import commands
 from emoji import emojize
-from sqlalchemy import select
+from sqlalchemy import bindparam, delete, select
+from sqlalchemy.dialects.postgresql import insert
 
 from server.config import settings
 from server.database import get_db_session_ctx
 from server.models import DiscordAuthorizedUser
 
-APP_SERVER_URL = settings.APP_SERVER_URL.rstrip('/')
+# The trailing slash keeps any path prefix of the server URL when the bot's relative
+# request paths are resolved against it.
+APP_SERVER_URL = settings.APP_SERVER_URL.rstrip('/') + '/'
 DISCORD_ADMIN_USER_ID = settings.DISCORD_ADMIN_USER_ID
 
+EMOJI_OK = emojize(':check_mark_button:')
+EMOJI_STOP = emojize(':stop_sign:')
+EMOJI_NO = emojize(':no_entry:')
+EMOJI_FROWN = emojize(':slight_frown:')
+EMOJI_WARN = emojize(':warning:')
+EMOJI_DIAMOND = emojize(':small_orange_diamond:')
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list[str]:
+    """Splits the given text into chunks that fit in a Discord message, preferably at line ends."""
+    chunks = []
+
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+
+        if cut <= 0:
+            cut = limit
+
+        chunks.append(text[:cut])
+        text = text[cut:].removeprefix('\n')
+
+    chunks.append(text)
+
+    return [chunk for chunk in chunks if chunk.strip()]
+
+_HELP_TEXT = f"""    
+    Shebang Remote Bot Commands:
+    
+    {EMOJI_DIAMOND} **No Auth Required Commands**
+    
+    **!help_**
+    _Shows this help message._
+    
+    **!whoami**
+    _Shows the current user info like name and ID._
+    
+    ---
+    
+    {EMOJI_DIAMOND} **Administrative Commands (Admin users only)**
+    
+    **!admin_allow_user** USER_ID
+    _Allow a user to use this bot._
+    
+    **!admin_disallow_user** USER_ID
+    _Disallow a user to use this bot._
+    
+    ---
+    
+    {EMOJI_DIAMOND} **Auth Required Commands**
+    
+    **!list_machines**
+    _List all active machines._
+    
+    **!register_script** "SCRIPT_NAME" "SCRIPT_CONTENT"
+    _Register a script that can be scheduled later to run on a host._
+    > Because the script name and its content may use 
+    words with spaces in between, you should quote them.
+    
+    **!execute_script** SCRIPT_NAME MACHINE_ID
+    _Schedule the execution of the given script to the given machine._
+    > The script name is the same name returned by `!register_script` command.
+    > The machine ID can be obtained using `!list_machines` command.
+    """
+_HELP_CHUNKS = split_message(_HELP_TEXT)
+
 # Logging setup
 logging_file = Path('logs/discord_bot.log')
 
@@ -35,66 +108,186 @@ logging_handler = RotatingFileHandler(
 
 logging_handler.setLevel(logging.INFO)
 
+# Records are handed over to a background thread, so file writes and rotations
+# never block the event loop.
+logging_queue = queue.SimpleQueue()
+logging_listener = QueueListener(
+    logging_queue,
+    logging_handler,
+    logging.StreamHandler(sys.stdout),
+    respect_handler_level=True,
+)
+logging_listener.start()
+atexit.register(logging_listener.stop)
+
 logging.basicConfig(
-    handlers=[logging_handler, logging.StreamHandler(sys.stdout)],
+    handlers=[QueueHandler(logging_queue)],
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
 )
 
+logger = logging.getLogger('discord_bot')
+
+# In-memory copy of the authorized users, kept in sync by the admin commands and
+# reloaded from the database every AUTHORIZED_USERS_TTL seconds.
+AUTHORIZED_USERS_TTL = 60
+_authorized_users: set[int] = set()
+_authorized_users_loaded_at: float | None = None
+
+# Serializes reloads, so concurrent commands don't each start one.
+_authorized_users_lock = asyncio.Lock()
+
+# Bumped by the admin commands; a reload that overlapped one of them read the database
+# before the change was applied in memory, so its snapshot is dropped.
+_authorized_users_generation = 0
+
+# Statements are built once, so SQLAlchemy's compiled cache is hit on every call.
+_SELECT_AUTHORIZED_USERS_STMT = select(DiscordAuthorizedUser.author_id)
+_INSERT_AUTHORIZED_USER_STMT = insert(DiscordAuthorizedUser).values(
+    author_id=bindparam('user_id'),
+).on_conflict_do_nothing(
+    index_elements=[DiscordAuthorizedUser.author_id],
+).returning(DiscordAuthorizedUser.author_id)
+_DELETE_AUTHORIZED_USER_STMT = delete(DiscordAuthorizedUser).where(
+    DiscordAuthorizedUser.author_id == bindparam('user_id'),
+).returning(DiscordAuthorizedUser.author_id)
+
 def get_authorized_users() -> list[int]:
-    """Reads the authorized users file decrypting its content."""
+    """Reads the authorized user ids from the database."""
     with get_db_session_ctx() as session:
-        authorized_users = session.scalars(select(DiscordAuthorizedUser)).all()
+        return list(session.scalars(_SELECT_AUTHORIZED_USERS_STMT))
 
-        return [i.author_id for i in authorized_users]
+def add_authorized_user(user_id: int) -> bool:
+    """Adds the given user to the authorized users, returns False if it was already there."""
+    with get_db_session_ctx() as session:
+        try:
+            added = session.scalar(_INSERT_AUTHORIZED_USER_STMT, {'user_id': user_id})
+            session.commit()
+
+        except Exception:
+            session.rollback()
+            raise
+
+        return added is not None
+
+def remove_authorized_user(user_id: int) -> bool:
+    """Removes the given user from the authorized users, returns False if it wasn't there."""
+    with get_db_session_ctx() as session:
+        try:
+            removed = session.scalar(_DELETE_AUTHORIZED_USER_STMT, {'user_id': user_id})
+            session.commit()
+
+        except Exception:
+            session.rollback()
+            raise
+
+        return removed is not None
 
 async def abort_chat(ctx: commands.Context) -> None:
     """Abort chat for not allowed users."""
-    await ctx.send(f'{emojize(":stop_sign:")} You are not authorized to use this command.')
+    await ctx.send(f'{EMOJI_STOP} You are not authorized to use this command.')
 
     return
 
+def authorized_users_expired() -> bool:
+    """Whether the in-memory authorized users must be reloaded from the database."""
+    return (
+        _authorized_users_loaded_at is None
+        or time.monotonic() - _authorized_users_loaded_at > AUTHORIZED_USERS_TTL
+    )
+
+def authorized_users_changed() -> None:
+    """Called by the admin commands after they changed the in-memory authorized users."""
+    global _authorized_users_generation
+
+    _authorized_users_generation += 1
+
+async def reload_authorized_users() -> None:
+    """Reloads the in-memory authorized users from the database, unless they're fresh."""
+    global _authorized_users_loaded_at
+
+    async with _authorized_users_lock:
+        if not authorized_users_expired():
+            return
+
+        generation = _authorized_users_generation
+        started_at = time.monotonic()
+
+        authorized_users = await asyncio.to_thread(get_authorized_users)
+
+        if generation != _authorized_users_generation:
+            # An admin command changed the users meanwhile, the next check reloads them.
+            return
+
+        _authorized_users.clear()
+        _authorized_users.update(authorized_users)
+
+        # Only set once the users are applied, so other commands wait on the lock for them
+        # instead of checking a set that's still being loaded.
+        _authorized_users_loaded_at = started_at
+
 async def is_allowed_user(ctx: commands.Context) -> bool:
     """Verify if the user is authorized to use this bot."""
-    user_id = ctx.author.id
+    # A reload dropped because of an admin command leaves the users expired, so it's retried.
+    while authorized_users_expired():
+        await reload_authorized_users()
 
-    with get_db_session_ctx() as session:
-        authorized_user = session.scalar(select(DiscordAuthorizedUser).filter(
-            DiscordAuthorizedUser.author_id == user_id,
-        ))
+    return ctx.author.id in _authorized_users
 
-        return authorized_user is not None
+class ShebangRemoteBot(commands.Bot):
+    """
+    The bot keeps a single HTTP session to the app server for its whole lifetime,
+    so commands reuse pooled keep-alive connections instead of opening new ones.
+    """
+    http_session: aiohttp.ClientSession | None = None
+
+    async def setup_hook(self) -> None:
+        self.http_session = aiohttp.ClientSession(
+            base_url=APP_SERVER_URL,
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(
+                limit=32, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=75,
+            ),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            json_serialize=lambda obj: orjson.dumps(obj).decode(),
+        )
+
+    async def close(self) -> None:
+        if self.http_session is not None:
+            await self.http_session.close()
+
+        await super().close()
 
 description = 'Shebang Remote bot to run Linux commands remotely from Discord.'
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', description=description, intents=intents)
+bot = ShebangRemoteBot(command_prefix='!', description=description, intents=intents)
 
 @bot.event
 async def on_command_error(ctx, error):
     # Handle "command not found"
     if isinstance(error, commands.CommandNotFound):
         await ctx.send(
-            f'{emojize(':warning:')} '
+            f'{EMOJI_WARN} '
             f'That command doesn’t exist. Try `!help_` for a list of commands.'
         )
 
     # Handle missing arguments.
     elif isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send(f'{emojize(':warning:')}️ Missing argument: `{error.param.name.upper()}`')
+        await ctx.send(f'{EMOJI_WARN}️ Missing argument: `{error.param.name.upper()}`')
 
     # Catch-all fallback for unexpected errors.
     else:
-        await ctx.send(f'{emojize(":no_entry:")} Oops! Something went wrong. Try again later.')
-        logging.error(f'Unexpected error in command {ctx.command}: {error}')
+        await ctx.send(f'{EMOJI_NO} Oops! Something went wrong. Try again later.')
+        logger.error('Unexpected error in command %s: %s', ctx.command, error)
 
 @bot.event
 async def on_ready():
     assert bot.user is not None
 
     msg = f'Logged in as {bot.user} (ID: {bot.user.id})'
-    logging.info(msg)
+    logger.info(msg)
 
     print(msg)
     print('------')
@@ -102,45 +295,8 @@ async def on_ready():
 @bot.command()
 async def help_(ctx: commands.Context) -> None:
     """Show the help command."""
-    text = f"""    
-    Shebang Remote Bot Commands:
-    
-    {emojize(':small_orange_diamond:')} **No Auth Required Commands**
-    
-    **!help_**
-    _Shows this help message._
-    
-    **!whoami**
-    _Shows the current user info like name and ID._
-    
-    ---
-    
-    {emojize(':small_orange_diamond:')} **Administrative Commands (Admin users only)**
-    
-    **!admin_allow_user** USER_ID
-    _Allow a user to use this bot._
-    
-    **!admin_disallow_user** USER_ID
-    _Disallow a user to use this bot._
-    
-    ---
-    
-    {emojize(':small_orange_diamond:')} **Auth Required Commands**
-    
-    **!list_machines**
-    _List all active machines._
-    
-    **!register_script** "SCRIPT_NAME" "SCRIPT_CONTENT"
-    _Register a script that can be scheduled later to run on a host._
-    > Because the script name and its content may use 
-    words with spaces in between, you should quote them.
-    
-    **!execute_script** SCRIPT_NAME MACHINE_ID
-    _Schedule the execution of the given script to the given machine._
-    > The script name is the same name returned by `!register_script` command.
-    > The machine ID can be obtained using `!list_machines` command.
-    """
-    await ctx.send(text)
+    for chunk in _HELP_CHUNKS:
+        await ctx.send(chunk)
 
 @bot.command()
 async def whoami(ctx: commands.Context):
@@ -153,151 +309,153 @@ async def whoami(ctx: commands.Context):
 @bot.command()
 async def admin_allow_user(ctx: commands.Context, user_id: int) -> None:
     """Administrative command to add a new user into authorized users."""
-    if ctx.author.id == DISCORD_ADMIN_USER_ID:
+    if ctx.author.id != DISCORD_ADMIN_USER_ID:
+        await abort_chat(ctx)
 
-        with get_db_session_ctx() as session:
-            if not session.scalar(select(DiscordAuthorizedUser).filter(
-                DiscordAuthorizedUser.author_id == user_id,
-            )):
-                try:
-                    session.add(DiscordAuthorizedUser(author_id=user_id))
-                    session.commit()
+        return
 
-                    await ctx.send(
-                        f'{emojize(":check_mark_button:")} '
-                        f'{ctx.author.name} is now an authorized user.'
-                    )
+    try:
+        added = await asyncio.to_thread(add_authorized_user, user_id)
 
-                except Exception:
-                    session.rollback()
-                    logging.exception('Something went wrong when adding user to authorized users.')
+    except Exception:
+        logger.exception('Something went wrong when adding user to authorized users.')
 
-                    await ctx.send(
-                        f'{emojize(":no_entry:")} Was not possible to add this user now.'
-                    )
+        await ctx.send(
+            f'{EMOJI_NO} Was not possible to add this user now.'
+        )
 
     else:
-        await abort_chat(ctx)
+        if added:
+            _authorized_users.add(user_id)
+            authorized_users_changed()
+
+            await ctx.send(
+                f'{EMOJI_OK} '
+                f'{ctx.author.name} is now an authorized user.'
+            )
 
 @bot.command()
 async def admin_disallow_user(ctx: commands.Context, user_id: int) -> None:
     """Administrative command to remove a user from authorized users."""
-    if ctx.author.id == DISCORD_ADMIN_USER_ID:
-
-        with get_db_session_ctx() as session:
-            existing_user = session.scalar(select(DiscordAuthorizedUser).filter(
-                DiscordAuthorizedUser.author_id == user_id,
-            ))
+    if ctx.author.id != DISCORD_ADMIN_USER_ID:
+        await abort_chat(ctx)
 
-            if existing_user:
-                try:
-                    session.delete(existing_user)
-                    session.commit()
+        return
 
-                    await ctx.send(
-                        f'{emojize(":check_mark_button:")} '
-                        f'{ctx.author.name} was removed from authorized users.'
-                    )
+    try:
+        removed = await asyncio.to_thread(remove_authorized_user, user_id)
 
-                except Exception:
-                    session.rollback()
-                    logging.exception(
-                        'Something went wrong when removing user from authorized users.'
-                    )
+    except Exception:
+        logger.exception('Something went wrong when removing user from authorized users.')
 
-                    await ctx.send(
-                        f'{emojize(":no_entry:")} Was not possible to disallow this user now.'
-                    )
+        await ctx.send(
+            f'{EMOJI_NO} Was not possible to disallow this user now.'
+        )
 
     else:
-        await abort_chat(ctx)
+        if removed:
+            _authorized_users.discard(user_id)
+            authorized_users_changed()
+
+            await ctx.send(
+                f'{EMOJI_OK} '
+                f'{ctx.author.name} was removed from authorized users.'
+            )
 
 @bot.command()
 async def list_machines(ctx: commands.Context):
     """List all active machines."""
-    async with aiohttp.ClientSession() as session:
-        if await is_allowed_user(ctx):
-            async with session.get(f'{APP_SERVER_URL}/machines') as response:
-                try:
-                    machines = await response.json()
+    if not await is_allowed_user(ctx):
+        await abort_chat(ctx)
 
-                    if response.status == 200:
-                        machines = json.dumps(machines, indent=4)
-                        await ctx.send(f'Máquinas ativas:\n\n {machines}')
+        return
 
-                except Exception:
-                    await ctx.send(f'{emojize(":no_entry:")} Ocorreu um erro inesperado.')
+    async with bot.http_session.get('machines') as response:
+        try:
+            if response.status == 200:
+                machines = await response.json(loads=orjson.loads)
+                machines = orjson.dumps(machines, option=orjson.OPT_INDENT_2).decode()
 
-        else:
-            await abort_chat(ctx)
+                for chunk in split_message(f'Máquinas ativas:\n\n {machines}'):
+                    await ctx.send(chunk)
+
+        except Exception:
+            await ctx.send(f'{EMOJI_NO} Ocorreu um erro inesperado.')
 
 @bot.command()
 async def register_script(ctx: commands.Context, name: str, content: str):
     """Add a script into the server with an uniq name and its content."""
-    payload = dict(name=name, content=content)
+    if not await is_allowed_user(ctx):
+        await abort_chat(ctx)
+
+        return
 
-    async with aiohttp.ClientSession() as session:
-        if await is_allowed_user(ctx):
-            async with session.post(f'{APP_SERVER_URL}/scripts', json=payload) as response:
-                try:
-                    data = await response.json()
+    payload = dict(name=name, content=content)
 
-                    if response.status == 200:
-                        await ctx.send(
-                            f'{emojize(":check_mark_button:")} '
-                            f'O script "{data.get('name')}" foi adicionado com sucesso.'
-                        )
+    async with bot.http_session.post('scripts', json=payload) as response:
+        try:
+            if response.status == 200:
+                data = await response.json(loads=orjson.loads)
 
-                    else:
-                        data = json.dumps(data, indent=4)
-                        msg = (
-                            f'{emojize(":slight_frown:")} '
-                            f'Não foi possível adicionar este script.\n\n{data}'
-                        )
+                await ctx.send(
+                    f'{EMOJI_OK} '
+                    f'O script "{data.get('name')}" foi adicionado com sucesso.'
+                )
 
-                        logging.error(f'{msg} :: Response code: {response.status}')
+            else:
+                # Error bodies are echoed as they came, cut to fit in a Discord message.
+                data = (await response.text())[:1800]
+                msg = (
+                    f'{EMOJI_FROWN} '
+                    f'Não foi possível adicionar este script.\n\n{data}'
+                )
 
-                        await ctx.send(msg)
+                logger.error('%s :: Response code: %s', msg, response.status)
 
-                except Exception:
-                    await ctx.send(f'{emojize(":no_entry:")} Ocorreu um erro inesperado.')
+                await ctx.send(msg)
 
-        else:
-            await abort_chat(ctx)
+        except Exception:
+            await ctx.send(f'{EMOJI_NO} Ocorreu um erro inesperado.')
 
 @bot.command()
 async def execute_script(ctx: commands.Context, name: str, machine_id: str):
     """Schedule the execution of the given script to the given machine."""
-    payload = dict(script_name=name, machine_id=machine_id)
-
-    async with aiohttp.ClientSession() as session:
-        if await is_allowed_user(ctx):
-            async with session.post(f'{APP_SERVER_URL}/execute', json=payload) as response:
-                try:
-                    data = await response.json()
-
-                    if response.status == 200:
-                        await ctx.send(
-                            f'{emojize(":check_mark_button:")} Sucesso!\n'
-                            f'O script "{name}" foi agendado para '
-                            f'ser executado na máquina "{machine_id}"'
-                        )
-
-                    else:
-                        data = json.dumps(data, indent=4)
-                        msg = (
-                            f'{emojize(":slight_frown:")} '
-                            f'Não foi possível agendar a execução deste script.\n\n{data}'
-                        )
-
-                        logging.error(f'{msg} :: Response code: {response.status}')
+    if not await is_allowed_user(ctx):
+        await abort_chat(ctx)
 
-                        await ctx.send(msg)
+        return
 
-                except Exception:
-                    await ctx.send(f'{emojize(":no_entry:")} Ocorreu um erro inesperado.')
+    payload = dict(script_name=name, machine_id=machine_id)
 
-        else:
-            await abort_chat(ctx)
+    async with bot.http_session.post('execute', json=payload) as response:
+        try:
+            if response.status == 200:
+                await ctx.send(
+                    f'{EMOJI_OK} Sucesso!\n'
+                    f'O script "{name}" foi agendado para '
+                    f'ser executado na máquina "{machine_id}"'
+                )
+
+            else:
+                data = (await response.text())[:1800]
+                msg = (
+                    f'{EMOJI_FROWN} '
+                    f'Não foi possível agendar a execução deste script.\n\n{data}'
+                )
+
+                logger.error('%s :: Response code: %s', msg, response.status)
+
+                await ctx.send(msg)
+
+        except Exception:
+            await ctx.send(f'{EMOJI_NO} Ocorreu um erro inesperado.')
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop ships with fastapi[standard], but the default event loop works just as well.
+    pass
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 bot.run(settings.DISCORD_BOT_TOKEN)
@@ -1,6 +1,9 @@
+from collections.abc import AsyncIterator
 from contextlib import contextmanager
 
 from sqlalchemy import create_engine, Engine
+from sqlalchemy.ext.asyncio import (create_async_engine, async_sessionmaker, AsyncEngine,
+                                    AsyncSession)
 from sqlalchemy.orm import sessionmaker, Session
 
 from server.config import settings
@@ -15,35 +18,52 @@ def get_db_engine() -> Engine:
 
     return engine
 
+def get_db_async_engine() -> AsyncEngine:
+    conn = settings.SQLALCHEMY_DATABASE_URI
+
+    # The psycopg dialect switches to its asyncio driver under create_async_engine.
+    engine = create_async_engine(
+        conn, echo=False, echo_pool=False, pool_recycle=60, pool_size=7, max_overflow=10
+    )
+
+    return engine
+
 DBSession = sessionmaker(autocommit=False, autoflush=False, bind=get_db_engine())
 
-def get_db_session() -> Session:
+# Objects stay usable after commit, since expired attributes can't be lazily reloaded
+# from async code.
+AsyncDBSession = async_sessionmaker(
+    autoflush=False, expire_on_commit=False, bind=get_db_async_engine()
+)
+
+async def get_db_session() -> AsyncIterator[AsyncSession]:
     """
-    FastAPI dependency generator that provides a database session.
+    FastAPI dependency generator that provides an async database session.
 
     Yields:
-        Session: SQLAlchemy Session object.
+        AsyncSession: SQLAlchemy AsyncSession object.
 
     Usage in FastAPI endpoints:
         @app.get("/users")
-        def read_users(db: Session = Depends(get_db_session)):
-            return db.query(User).all()
+        async def read_users(db: AsyncSession = Depends(get_db_session)):
+            return (await db.scalars(select(User))).all()
 
     Notes:
         - The session is automatically closed by FastAPI after the request finishes.
         - Do not call this function directly outside FastAPI dependency injection
-          (it returns a generator, not a Session object).
+          (it returns an async generator, not an AsyncSession object).
+        - Relationships are not lazily loaded in async code, load them eagerly instead.
     """
     from server.main import logger
 
-    session = DBSession()
+    session = AsyncDBSession()
     try:
         yield session
     except Exception as e:
         logger.exception('Failed to create session', exc_info=True)
         raise e
     finally:
-        session.close()
+        await session.close()
 
 @contextmanager
 def get_db_session_ctx() -> Session:
@@ -1,14 +1,18 @@
+import atexit
 import logging
+import queue
 import sys
 
 from contextlib import asynccontextmanager
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
 from fastapi import FastAPI
-from sqlalchemy import select
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import Connection
+from sqlalchemy.dialects.postgresql import insert
 
-from server.database import get_db_engine, DBSession
+from server.database import get_db_engine
 from server.models import BaseModel, CommandStatusReference
 from server.views import router as server_views_router
 
@@ -31,10 +35,22 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 
 logging_handler.setLevel(logging.INFO)
 logging_handler.setFormatter(formatter)
-logger.addHandler(logging_handler)
-logger.addHandler(logging.StreamHandler(sys.stdout))
 
-def post_init_database() -> None:
+# Records are handed over to a background thread, so file writes and rotations
+# never block the request handlers.
+logging_queue = queue.SimpleQueue()
+logging_listener = QueueListener(
+    logging_queue,
+    logging_handler,
+    logging.StreamHandler(sys.stdout),
+    respect_handler_level=True,
+)
+logging_listener.start()
+atexit.register(logging_listener.stop)
+
+logger.addHandler(QueueHandler(logging_queue))
+
+def post_init_database(connection: Connection) -> None:
     """Perform post-initialization tasks for the database."""
 
     # Populates CommandStatusReference table.
@@ -43,25 +59,31 @@ def post_init_database() -> None:
         ('Completed', 'completed'),
     ]
 
-    with DBSession() as session:
-        for status in command_status:
-            if not session.scalar(
-                    select(CommandStatusReference).filter_by(title_internal=status[1])):
-                session.add(
-                    CommandStatusReference(
-                        title=status[0],
-                        title_internal=status[1],
-                    )
-                )
+    stmt = insert(CommandStatusReference).values([
+        dict(title=title, title_internal=title_internal)
+        for title, title_internal in command_status
+    ]).on_conflict_do_nothing(index_elements=[CommandStatusReference.title_internal])
 
-        session.commit()
+    connection.execute(stmt)
 
 def init_database() -> None:
     """Initialize the database creating tables if they do not exist."""
-    BaseModel.metadata.create_all(bind=get_db_engine())
+    engine = get_db_engine()
+
+    # Tables and seed data are created in a single transaction on one connection.
+    with engine.begin() as connection:
+        BaseModel.metadata.create_all(bind=connection)
+
+        # create_all skips existing tables along with their indexes, so indexes added later
+        # are created here.
+        for table in BaseModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+        # Run post-initialization tasks.
+        post_init_database(connection)
 
-    # Run post-initialization tasks.
-    post_init_database()
+    engine.dispose()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -69,7 +91,7 @@ async def lifespan(app: FastAPI):
 
     yield
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Register routes
 app.include_router(server_views_router)
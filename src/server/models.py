@@ -2,7 +2,8 @@ import datetime
 
 from dataclasses import dataclass
 
-from sqlalchemy import func, MetaData, String, Text, TIMESTAMP, DATE, ForeignKey, BigInteger
+from sqlalchemy import (func, Index, MetaData, String, Text, TIMESTAMP, DATE, ForeignKey,
+                        BigInteger)
 from sqlalchemy.orm import DeclarativeBase, declared_attr, Mapped, mapped_column, relationship
 
 
@@ -34,6 +35,10 @@ class BaseModel(DeclarativeBase):
     """Base model class that offers common functionality."""
     __abstract__ = True
 
+    # Server generated values are fetched with RETURNING when rows are flushed, so objects
+    # don't need to be refreshed afterwards.
+    __mapper_args__ = {'eager_defaults': True}
+
     metadata: MetaData = MetaData(naming_convention=NAMING_CONVENTION)
 
     type_annotation_map = {
@@ -77,6 +82,11 @@ class Machine(BaseModel):
         - last_seen: Timestamp of the last time the machine checked in
         - commands: List of commands assigned to this machine
     """
+    # Serves the active machines listing, which filters on last_seen.
+    __table_args__ = (
+        Index('ix__machine__last_seen', 'last_seen'),
+    )
+
     id: Mapped[BaseTypes.str255] = mapped_column(primary_key=True)
     name: Mapped[BaseTypes.str45]
     last_seen: Mapped[BaseTypes.timestamp]
@@ -139,6 +149,11 @@ class Command(BaseModel):
         This model is used by the API endpoint `GET /commands/{machine_id}`
         to retrieve pending commands for a specific agent/machine.
     """
+    # Serves the pending commands lookup, which filters on the machine and the status.
+    __table_args__ = (
+        Index('ix__command__machine_id__status_id', 'machine_id', 'status_id'),
+    )
+
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
 
     machine_id: Mapped[BaseTypes.str255] = mapped_column(
@@ -1,11 +1,41 @@
-import json
 import re
 import shlex
 
 from datetime import datetime
-from typing import Set, Iterable
 
-from pydantic import BaseModel, field_validator
+import orjson
+
+from pydantic import BaseModel, ConfigDict, field_validator
+
+# Commands that scripts are allowed to run.
+ALLOWED_COMMANDS = frozenset({
+    'awk', 'basename', 'cat', 'cd', 'cp', 'cut', 'date', 'df', 'diff', 'diff3', 'dig',
+    'dirname', 'dmesg', 'dmidecode', 'du', 'echo', 'env', 'find', 'free', 'grep', 'head',
+    'help', 'history', 'host', 'hostname', 'id', 'info', 'ip', 'journalctl', 'less', 'll',
+    'ls', 'lsof', 'man', 'md5sum', 'mkdir', 'more', 'nmap', 'ping', 'printenv', 'printf',
+    'ps', 'pwd', 'readlink', 'rmdir', 'sar', 'sed', 'sleep', 'sort', 'ss', 'stat', 'tac',
+    'tail', 'tar', 'touch', 'tr', 'uname', 'uniq', 'uptime', 'vmstat', 'wc', 'which',
+    'whoami', 'whois', 'xargs'
+})
+
+# Paths (prefixes) that must NOT be accessed (read or write), either exactly or below them.
+FORBIDDEN_PATH_RE = re.compile(
+    r'^(?:/etc|/root|/boot|/dev|/proc|/sys|/var/lib|/var/run|/run)(?:/|$)'
+)
+
+# Very unsafe tokens we outright disallow anywhere in the script, even inside other words.
+DISALLOWED_TOKENS_RE = re.compile(r';|&&|\|\||`|\$\(|sudo|su')
+
+# Size limits checked before any parsing, so oversized scripts are rejected cheaply.
+SCRIPT_MAX_LENGTH = 65_536
+SCRIPT_MAX_LINES = 2000
+
+ENV_ASSIGNMENT_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+
+# Segments without quotes or escapes split into the same tokens shlex would give, using
+# only the whitespace characters shlex splits on.
+SHLEX_QUOTING_RE = re.compile(r'[\'"\\]')
+SHLEX_WORD_RE = re.compile(r'[^ \t\r\n]+')
 
 
 class DefaultResponseSchemaMixin:
@@ -17,43 +47,33 @@ class MachineSchema(BaseModel):
     id: str
     name: str
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class MachineResponseSchema(DefaultResponseSchemaMixin, MachineSchema):
     last_seen: datetime
 
 
-class ScriptSchema(BaseModel):
+class ScriptBaseSchema(BaseModel):
     name: str
     content: str
 
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ScriptSchema(ScriptBaseSchema):
+    """Validates scripts sent by clients, stored scripts are returned as they are."""
+
     @field_validator('content', mode='before')
     def validate_allowed_commands(cls, v: str) -> str:
-        allowed_commands: Set[str] = {
-            'awk', 'basename', 'cat', 'cd', 'cp', 'cut', 'date', 'df', 'diff', 'diff3', 'dig',
-            'dirname', 'dmesg', 'dmidecode', 'du', 'echo', 'env', 'find', 'free', 'grep', 'head',
-            'help', 'history', 'host', 'hostname', 'id', 'info', 'ip', 'journalctl', 'less', 'll',
-            'ls', 'lsof', 'man', 'md5sum', 'mkdir', 'more', 'nmap', 'ping', 'printenv', 'printf',
-            'ps', 'pwd', 'readlink', 'rmdir', 'sar', 'sed', 'sleep', 'sort', 'ss', 'stat', 'tac',
-            'tail', 'tar', 'touch', 'tr', 'uname', 'uniq', 'uptime', 'vmstat', 'wc', 'which',
-            'whoami', 'whois', 'xargs'
-        }
-
-        # Paths (prefixes) that must NOT be accessed (read or write)
-        forbidden_path_prefixes: Iterable[str] = (
-            '/etc', '/root', '/boot', '/dev', '/proc', '/sys', '/var/lib', '/var/run', '/run'
-        )
-
-        # Very unsafe tokens we outright disallow anywhere in the script
-        disallowed_tokens: Iterable[str] = (
-            ';', '&&', '||', '`', '$(', 'sudo', 'su'
-        )
-
         if not v:
             return v
 
+        if len(v) > SCRIPT_MAX_LENGTH:
+            raise ValueError(f'Script is too large (more than {SCRIPT_MAX_LENGTH} characters)')
+        if v.count('\n') > SCRIPT_MAX_LINES:
+            raise ValueError(f'Script has too many lines (more than {SCRIPT_MAX_LINES})')
+
         # Helper: check whether a token references a forbidden path
         def token_references_forbidden_path(tok: str) -> bool:
             # simple canonicalization: remove quotes
@@ -66,19 +86,12 @@ class ScriptSchema(BaseModel):
                         '~/root'):
                     return True
                 # otherwise be lenient and do not consider ~ as forbidden
-            if not tok_clean.startswith('/'):
-                return False
-            for pref in forbidden_path_prefixes:
-                # consider exact prefix or prefix + '/'
-                if tok_clean == pref or tok_clean.startswith(pref + '/'):
-                    return True
-            return False
+            return FORBIDDEN_PATH_RE.match(tok_clean) is not None
 
         # Quick overall-scan for disallowed tokens (anywhere)
-        lowered = v.lower()
-        for bad in disallowed_tokens:
-            if bad in lowered:
-                raise ValueError(f'Script contains disallowed token or construct: "{bad}"')
+        bad = DISALLOWED_TOKENS_RE.search(v.lower())
+        if bad:
+            raise ValueError(f'Script contains disallowed token or construct: "{bad.group()}"')
 
         # Break into lines and validate each "command line". Comments/blank lines ignored.
         for lineno, raw_line in enumerate(v.splitlines(), start=1):
@@ -100,11 +113,14 @@ class ScriptSchema(BaseModel):
                     raise ValueError(f'Empty pipeline segment in line {lineno}')
 
                 # Handle redirections: we'll parse tokens and keep track if there's a '>' or '<'
-                try:
-                    tokens = shlex.split(seg, comments=False)
-                except ValueError:
-                    raise ValueError(
-                        f'Unable to safely parse tokens (shell quoting issue) on line {lineno}')
+                if SHLEX_QUOTING_RE.search(seg):
+                    try:
+                        tokens = shlex.split(seg, comments=False)
+                    except ValueError:
+                        raise ValueError(
+                            f'Unable to safely parse tokens (shell quoting issue) on line {lineno}')
+                else:
+                    tokens = SHLEX_WORD_RE.findall(seg)
 
                 if not tokens:
                     raise ValueError(f'No tokens found in pipeline segment on line {lineno}')
@@ -113,7 +129,7 @@ class ScriptSchema(BaseModel):
                 cmd_token = None
                 token_index = 0
                 for i, tok in enumerate(tokens):
-                    if re.match(r'^[A-Za-z_][A-Za-z0-9_]*=', tok):
+                    if ENV_ASSIGNMENT_RE.match(tok):
                         continue
                     # first non env-assignment token is expected to be command
                     cmd_token = tok
@@ -131,7 +147,7 @@ class ScriptSchema(BaseModel):
                 # Normalize to lowercase for comparison
                 cmd_basename_l = cmd_basename.lower()
 
-                if cmd_basename_l not in allowed_commands:
+                if cmd_basename_l not in ALLOWED_COMMANDS:
                     raise ValueError(f'Command "{cmd_token}" is not allowed (line {lineno})')
 
                 # Now inspect remaining tokens for forbidden paths or dangerous file writes
@@ -166,11 +182,8 @@ class ScriptSchema(BaseModel):
     def normalize_name(cls, value):
         return value.replace(' ', '').lower().strip()
 
-    class Config:
-        from_attributes = True
-
 
-class ScriptResponseSchema(DefaultResponseSchemaMixin, ScriptSchema):
+class ScriptResponseSchema(DefaultResponseSchemaMixin, ScriptBaseSchema):
     pass
 
 
@@ -178,19 +191,20 @@ class CommandStatusReferenceResponseSchema(DefaultResponseSchemaMixin, BaseModel
     title: str
     title_internal: str
 
+    model_config = ConfigDict(from_attributes=True)
+
 
 class CommandSchema(BaseModel):
     machine_id: str
     script_name: str
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class CommandResponseSchema(DefaultResponseSchemaMixin, CommandSchema):
     id: int
     status: CommandStatusReferenceResponseSchema
-    script: ScriptSchema
+    script: ScriptBaseSchema
     output: str | None
 
 
@@ -202,8 +216,12 @@ class CommandResultSchema(BaseModel):
         from server.main import logger
 
         try:
-            return json.dumps(value)
-        except TypeError:
-            logger.exception(f'Unable to serialize output "{value}"')
+            return orjson.dumps(value).decode()
+        except orjson.JSONEncodeError:
+            logger.exception('Unable to serialize output "%s"', value)
 
             return value
+
+
+class CommandBulkResultSchema(CommandResultSchema):
+    id: int
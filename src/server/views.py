@@ -1,26 +1,30 @@
 import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session, InstrumentedAttribute
+from fastapi import (APIRouter, Depends, Header, HTTPException, Response, status, WebSocket,
+                     WebSocketDisconnect, WebSocketException)
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute, contains_eager, raiseload, selectinload
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import select
+from sqlalchemy import bindparam, exists, select, update
+from sqlalchemy.dialects.postgresql import insert
 
 from server.database import get_db_session
 from server.models import Machine, CommandStatusReference, Command, Script, BaseModel
 from server.serializers import (MachineSchema, MachineResponseSchema, CommandSchema,
                                 CommandResponseSchema, ScriptResponseSchema, ScriptSchema,
-                                CommandResultSchema)
+                                CommandResultSchema, CommandBulkResultSchema)
 
 
-def get_object_or_404(
-        session: Session,
+async def get_object_or_404(
+        session: AsyncSession,
         model: BaseModel,
         column: InstrumentedAttribute,
         id_: str | int
 ):
     from server.main import logger
 
-    obj = session.scalar(select(model).filter(column == id_))
+    obj = await session.scalar(select(model).filter(column == id_))
 
     if not obj:
         detail = f'{model.__name__} with id {id_} was not found'
@@ -34,83 +38,171 @@ def get_object_or_404(
 
     return obj
 
+async def exists_or_404(
+        session: AsyncSession,
+        *checks: tuple[BaseModel, InstrumentedAttribute, str | int]
+) -> None:
+    """
+    Like get_object_or_404, for when only the existence of the objects matters.
+    Each check is a (model, column, id_) tuple, all of them are verified in a single query.
+    """
+    from server.main import logger
+
+    found = (await session.execute(
+        select(*(exists().where(column == id_) for _, column, id_ in checks))
+    )).one()
+
+    for (model, _, id_), exists_ in zip(checks, found):
+        if not exists_:
+            detail = f'{model.__name__} with id {id_} was not found'
+
+            logger.error(detail)
+
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=detail
+            )
+
+# Statements run on every request are built once, each execution only binds its parameters.
+_SELECT_STATUS_ID_STMT = select(CommandStatusReference.id).filter(
+    CommandStatusReference.title_internal == bindparam('title_internal')
+)
+
+_SELECT_PENDING_COMMANDS_STMT = select(Command).join(Command.status).filter(
+    Command.machine_id == bindparam('machine_id'),
+    CommandStatusReference.title_internal == 'pending'
+).options(contains_eager(Command.status), selectinload(Command.script), raiseload('*'))
+
+# Only the columns in the response are selected, no Machine objects are built.
+_SELECT_ACTIVE_MACHINES_STMT = select(
+    Machine.id, Machine.name, Machine.last_seen, Machine.created_at, Machine.updated_at,
+).filter(
+    Machine.last_seen >= bindparam('deadline'),
+)
+
+_SELECT_MACHINE_STMT = select(Machine).filter(Machine.id == bindparam('machine_id'))
+
+_SELECT_COMMANDS_STMT = select(Command).filter(
+    Command.id.in_(bindparam('command_ids', expanding=True))
+)
+
+# Ids of the command status reference rows, by title_internal. They never change once seeded.
+_STATUS_CACHE: dict[str, int] = {}
+
+async def get_status_id(session: AsyncSession, title_internal: str) -> int:
+    """Return the id of the command status with the given internal title."""
+    status_id = _STATUS_CACHE.get(title_internal)
+
+    if status_id is None:
+        status_id = await session.scalar(
+            _SELECT_STATUS_ID_STMT, {'title_internal': title_internal}
+        )
+        _STATUS_CACHE[title_internal] = status_id
+
+    return status_id
+
+async def get_pending_commands(session: AsyncSession, machine_id: str):
+    """
+    Return the pending commands of the given machine, with their script and status loaded.
+    The status comes from the join used to filter, any other relationship access raises.
+    """
+    return (await session.scalars(
+        _SELECT_PENDING_COMMANDS_STMT, {'machine_id': machine_id}
+    )).all()
+
+# last_seen is only written when it's older than this, which is plenty for the 5 minutes
+# activity window and spares a row update on every poll or heartbeat of chatty agents.
+LAST_SEEN_PRECISION = datetime.timedelta(seconds=30)
+
+# ETag of an empty pending commands list, so polling agents can get a bodiless 304 instead.
+EMPTY_PENDING_COMMANDS_ETAG = '"no-pending-commands"'
+
+# Built once, the hot listing endpoints serialize straight to JSON bytes with them.
+COMMANDS_ADAPTER = TypeAdapter(list[CommandResponseSchema])
+MACHINES_ADAPTER = TypeAdapter(list[MachineResponseSchema])
+
+def commands_to_json(commands: list[Command]) -> bytes:
+    """Serialize the given commands the same way CommandResponseSchema does."""
+    return COMMANDS_ADAPTER.dump_json(
+        COMMANDS_ADAPTER.validate_python(commands, from_attributes=True)
+    )
+
+# WebSockets of the agents connected to this process, by machine id.
+agent_websockets: dict[str, WebSocket] = {}
+
+async def push_commands(machine_id: str, commands: list[Command]) -> None:
+    """Send the given commands to the machine's agent if it's connected through a WebSocket."""
+    from server.main import logger
+
+    websocket = agent_websockets.get(machine_id)
+
+    if websocket is None:
+        return
+
+    try:
+        await websocket.send_text(commands_to_json(commands).decode())
+
+    except Exception:
+        logger.exception('Unable to push commands to machine %s', machine_id, exc_info=True)
+
 router = APIRouter()
 
 @router.get('/machines', response_model=list[MachineResponseSchema])
-async def list_machines(session: Session = Depends(get_db_session)):
+async def list_machines(session: AsyncSession = Depends(get_db_session)):
     """
     Return active machines.
     Active machines are those that sent a 'ping' in the last 5 minutes.
     """
     deadline = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=5)
 
-    machines = session.scalars(select(Machine).filter(
-        Machine.last_seen >= deadline,
+    machines = (await session.execute(
+        _SELECT_ACTIVE_MACHINES_STMT, {'deadline': deadline}
     )).all()
 
-    return machines
+    return Response(
+        content=MACHINES_ADAPTER.dump_json(
+            MACHINES_ADAPTER.validate_python(machines, from_attributes=True)
+        ),
+        media_type='application/json',
+    )
 
 @router.post('/register_machine', response_model=MachineResponseSchema)
 async def create_update_machine(
         model: MachineSchema,
-        session: Session = Depends(get_db_session)
+        session: AsyncSession = Depends(get_db_session)
 ):
     """
     Create or update machines.
     """
     from server.main import logger
 
-    existing_machine = session.scalar(
-        select(Machine).filter(Machine.id == model.id)
-    )
-
     now = datetime.datetime.now(datetime.timezone.utc)
 
-    if not existing_machine:
-        # Create new machine.
-        new_machine = Machine(**model.model_dump())
-        new_machine.last_seen = now
-
-        session.add(new_machine)
-
-        try:
-            session.commit()
-            session.refresh(new_machine)
-
-            return new_machine
-
-        except Exception:
-            session.rollback()
-
-            detail = 'Something went wrong when creating machine.'
-            logger.exception(detail, exc_info=True)
-
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
-
-    # Update existing machine.
-    for key, value in model.model_dump().items():
-        setattr(existing_machine, key, value)
-
-    existing_machine.last_seen = now
+    # Creates the machine or, when it already exists, updates it in a single statement.
+    # The onupdate default doesn't apply to ON CONFLICT updates, so updated_at is set here.
+    stmt = insert(Machine).values(**model.model_dump(), last_seen=now).on_conflict_do_update(
+        index_elements=[Machine.id],
+        set_=dict(**model.model_dump(exclude={'id'}), last_seen=now, updated_at=now),
+    ).returning(Machine)
 
     try:
-        session.commit()
-        session.refresh(existing_machine)
+        machine = await session.scalar(stmt)
+        await session.commit()
 
     except Exception:
-        session.rollback()
+        await session.rollback()
 
-        detail = 'Something went wrong when updating machine.'
+        detail = 'Something went wrong when registering machine.'
         logger.exception(detail, exc_info=True)
 
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
-    return existing_machine
+    return machine
 
 @router.post('/scripts', response_model=ScriptResponseSchema)
 async def create_script(
         model: ScriptSchema,
-        session: Session = Depends(get_db_session)
+        session: AsyncSession = Depends(get_db_session)
 ):
     """
     Create a script with an uniq name and its content.
@@ -121,10 +213,10 @@ async def create_script(
     session.add(new_script)
 
     try:
-        session.commit()
+        await session.commit()
 
     except IntegrityError:
-        session.rollback()
+        await session.rollback()
 
         detail = f'Script with name {model.name} already exists.'
         logger.error(detail, exc_info=True)
@@ -135,117 +227,228 @@ async def create_script(
         )
 
     except Exception:
-        session.rollback()
+        await session.rollback()
         detail = 'Something went wrong when creating script.'
         logger.exception(detail, exc_info=True)
 
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
-    session.refresh(new_script)
-
     return new_script
 
 @router.post('/execute', response_model=CommandResponseSchema)
 async def schedule_machine_command(
         model: CommandSchema,
-        session: Session = Depends(get_db_session)
+        session: AsyncSession = Depends(get_db_session)
 ):
     """
     Schedule a command for a machine.
     """
     from server.main import logger
 
-    pending_status = session.scalar(select(CommandStatusReference).filter(
-        CommandStatusReference.title_internal == 'pending'
-    ))
-
     # Check if script and machine exist.
-    get_object_or_404(
-        session=session, model=Machine, column=Machine.id, id_=model.machine_id
+    await exists_or_404(
+        session,
+        (Machine, Machine.id, model.machine_id),
+        (Script, Script.name, model.script_name),
     )
 
-    get_object_or_404(
-        session=session, model=Script, column=Script.name, id_=model.script_name
-    )
-
-    # Create and persist command.
-    new_command = Command(**model.model_dump())
-    new_command.status = pending_status
-
-    session.add(new_command)
+    # Create and persist command, its script and status are loaded along with it since the
+    # response and the pushed message include them.
+    stmt = insert(Command).values(
+        **model.model_dump(), status_id=await get_status_id(session, 'pending')
+    ).returning(Command).options(selectinload(Command.script), selectinload(Command.status))
 
     try:
-        session.commit()
-        session.refresh(new_command)
-        return new_command
+        new_command = await session.scalar(stmt)
+        await session.commit()
 
     except Exception:
-        session.rollback()
+        await session.rollback()
         detail = 'Something went wrong when scheduling command.'
         logger.exception(detail, exc_info=True)
 
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
+    await push_commands(model.machine_id, [new_command])
+
+    return new_command
+
 @router.get('/commands/{machine_id}', response_model=list[CommandResponseSchema])
 async def list_pending_commands(
         machine_id: str,
-        session: Session = Depends(get_db_session)
+        if_none_match: str | None = Header(default=None),
+        session: AsyncSession = Depends(get_db_session)
 ):
     """
     Get pending commands for an agent.
+    When there are none, responds 304 Not Modified to agents that already got an empty list.
     """
     now = datetime.datetime.now(datetime.timezone.utc)
 
+    touched_machine_id = await session.scalar(
+        update(Machine).filter(
+            Machine.id == machine_id,
+            Machine.last_seen < now - LAST_SEEN_PRECISION,
+        ).values(last_seen=now).returning(Machine.id)
+    )
+
+    # Nothing was touched, either the machine was seen recently or it doesn't exist.
+    if touched_machine_id is None:
+        await exists_or_404(session, (Machine, Machine.id, machine_id))
+
+    pending_commands = await get_pending_commands(session, machine_id)
 
-    machine = get_object_or_404(
-        session=session, model=Machine, column=Machine.id, id_=machine_id
+    await session.commit()
+
+    headers = {}
+
+    if not pending_commands:
+        if if_none_match == EMPTY_PENDING_COMMANDS_ETAG:
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={'ETag': EMPTY_PENDING_COMMANDS_ETAG},
+            )
+
+        headers['ETag'] = EMPTY_PENDING_COMMANDS_ETAG
+
+    return Response(
+        content=commands_to_json(pending_commands),
+        media_type='application/json',
+        headers=headers,
     )
 
-    machine.last_seen = now
-    session.commit()
-    session.refresh(machine)
+@router.websocket('/commands/ws/{machine_id}')
+async def pending_commands_websocket(
+        websocket: WebSocket,
+        machine_id: str,
+        session: AsyncSession = Depends(get_db_session)
+):
+    """
+    Push pending commands to an agent as soon as they are scheduled.
+    Messages received from the agent are heartbeats that keep the machine active, each one
+    gets the commands that are still pending sent again.
+    """
+    machine = await session.scalar(_SELECT_MACHINE_STMT, {'machine_id': machine_id})
 
-    pending_commands = session.scalars(
-        select(Command).join(CommandStatusReference).filter(
-            Command.machine_id == machine_id,
-            CommandStatusReference.title_internal == 'pending'
+    if not machine:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION,
+            reason=f'Machine with id {machine_id} was not found'
         )
-    ).all()
 
-    return pending_commands
+    await websocket.accept()
+    agent_websockets[machine_id] = websocket
+
+    try:
+        machine.last_seen = datetime.datetime.now(datetime.timezone.utc)
+        await session.commit()
+
+        pending_commands = await get_pending_commands(session, machine_id)
+
+        if pending_commands:
+            await push_commands(machine_id, pending_commands)
+
+        # End the read transaction so no connection is held while waiting for messages.
+        await session.commit()
+
+        while True:
+            await websocket.receive_text()
+
+            now = datetime.datetime.now(datetime.timezone.utc)
+
+            if machine.last_seen < now - LAST_SEEN_PRECISION:
+                machine.last_seen = now
+
+            # Pushes only reach agents connected to the process that scheduled the command,
+            # and may fail, so pending commands are re-sent. Agents skip those they know.
+            pending_commands = await get_pending_commands(session, machine_id)
+
+            # Also ends the read transaction, until the next message.
+            await session.commit()
+
+            if pending_commands:
+                await websocket.send_text(commands_to_json(pending_commands).decode())
+
+    except WebSocketDisconnect:
+        pass
+
+    finally:
+        if agent_websockets.get(machine_id) is websocket:
+            del agent_websockets[machine_id]
 
 @router.post('/commands/{command_id}/result')
 async def store_command_result(
         command_id: int,
         result: CommandResultSchema,
-        session: Session = Depends(get_db_session)
+        session: AsyncSession = Depends(get_db_session)
 ):
     """
     Stores a result of an executed command.
     """
     from server.main import logger
 
-    completed_status = session.scalar(select(CommandStatusReference).filter(
-        CommandStatusReference.title_internal == 'completed'
-    ))
+    completed_status_id = await get_status_id(session, 'completed')
 
-    existing_command = get_object_or_404(
+    existing_command = await get_object_or_404(
         session=session, model=Command, column=Command.id, id_=command_id
     )
 
     # Updates the existing_command with the given result data.
     existing_command.output = result.output
-    existing_command.status = completed_status
+    existing_command.status_id = completed_status_id
 
     session.add(existing_command)
 
     try:
-        session.commit()
-        session.refresh(existing_command)
+        await session.commit()
 
     except Exception:
-        session.rollback()
+        await session.rollback()
         detail = 'Something went wrong when storing command result.'
         logger.exception(detail, exc_info=True)
 
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+@router.post('/commands/results')
+async def store_command_results(
+        results: list[CommandBulkResultSchema],
+        session: AsyncSession = Depends(get_db_session)
+):
+    """
+    Stores the results of several executed commands at once.
+    """
+    from server.main import logger
+
+    completed_status_id = await get_status_id(session, 'completed')
+
+    existing_commands = {
+        command.id: command
+        for command in await session.scalars(
+            _SELECT_COMMANDS_STMT, {'command_ids': [result.id for result in results]}
+        )
+    }
+
+    missing_ids = [str(result.id) for result in results if result.id not in existing_commands]
+
+    if missing_ids:
+        detail = f'Commands with ids {", ".join(missing_ids)} were not found'
+
+        logger.error(detail)
+
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+
+    # Updates the existing commands with the given results data.
+    for result in results:
+        existing_command = existing_commands[result.id]
+        existing_command.output = result.output
+        existing_command.status_id = completed_status_id
+
+    try:
+        await session.commit()
+
+    except Exception:
+        await session.rollback()
+        detail = 'Something went wrong when storing command results.'
+        logger.exception(detail, exc_info=True)
+
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)